@@ -1,7 +1,7 @@
 # -*- coding: utf-8 -*-
 # streamlit_app.py
 # SPOOFER — Vidéo (Streamlit) — Export unique en QUALITÉ MAX
-# - MP4 (H.264 lossless CRF=0) + AAC 320k, yuv420p, faststart
+# - MP4 (H.264 CRF=18, visually lossless ; NVENC si GPU NVIDIA) + AAC 320k, yuv420p, moov en tête (MP4 fragmenté)
 # - Effets: Normal / B&W / B&W contrasté / Golden Hour
 # - Rotation: -90° / +90° / 180°
 # - Miroir: aperçu (info) + export x2 (Normal + Miroir) si coché
@@ -12,11 +12,16 @@
 # - requirements.txt (streamlit)
 # - packages.txt (ffmpeg)
 
-import os, io, zipfile, tempfile, shutil, subprocess
-from typing import List, Tuple, Dict, Optional, Iterable
+from __future__ import annotations
+
+import os, re, zipfile, tempfile, shutil, subprocess, threading, functools
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Any, BinaryIO, List, Tuple, Dict, Optional, Union
 import streamlit as st
 
 # ------------------- Détection ffmpeg -------------------
+# Mis en cache pour toute la durée du process : Streamlit ré-exécute le script à chaque interaction
+@st.cache_resource(show_spinner=False)
 def has_ffmpeg() -> bool:
     try:
         subprocess.run(["ffmpeg", "-version"], stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
@@ -24,95 +29,334 @@ def has_ffmpeg() -> bool:
     except Exception:
         return False
 
+@st.cache_resource(show_spinner=False)
+def has_nvenc() -> bool:
+    # h264_nvenc peut être compilé sans GPU présent : on tente un micro-encodage avec les options
+    # réellement utilisées (un ffmpeg/driver trop ancien rejette p5/hq/cq dès ce test)
+    try:
+        if "h264_nvenc" not in subprocess.run(["ffmpeg", "-hide_banner", "-encoders"], capture_output=True, text=True).stdout:
+            return False
+        subprocess.run(["ffmpeg", "-hide_banner", "-loglevel", "error",
+                        "-f", "lavfi", "-i", "color=black:s=256x256:d=0.1"]
+                       + NVENC_CODEC_ARGS + ["-f", "null", "-"],
+                       stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
+        return True
+    except Exception:
+        return False
+
 FFMPEG_OK = has_ffmpeg()
 
 # ------------------- Constantes -------------------
+# Upload passé à ffmpeg/ffprobe sur stdin : memoryview (getbuffer) pour éviter une copie
+BytesLike = Union[bytes, memoryview]
+
 SUPPORTED_EXTS = {'.mp4', '.mov', '.m4v', '.webm', '.mkv', '.avi', '.mpeg', '.mpg', '.wmv'}
+# Conteneurs qui exigent une entrée seekable (index/moov) : écrits sur disque avant ffmpeg.
+# Les autres (MKV, WEBM, MPEG) sont envoyés à ffmpeg via stdin.
+SEEKABLE_REQUIRED = {'.mp4', '.mov', '.m4v', '.avi', '.wmv'}
 ROTATIONS_ALLOWED = {0, 90, 180, 270}
 
+# Erreurs d'ouverture de la source (illisible avant toute image) : process tué immédiatement.
+# "Invalid data found when processing input" n'en fait pas partie : ffmpeg l'écrit aussi en cours
+# de flux (paquet abîmé, MKV/WEBM tronqué), le traite comme une fin de fichier et termine l'export.
+FFMPEG_FATAL_ERRORS = re.compile(r"moov atom not found|Error opening input", re.IGNORECASE)
+
+# Effet -> chaîne de filtres ffmpeg ("normal" = aucun filtre)
+# N&B via format=gray : on garde la luma et on jette la chroma (copie mémoire, pas de calcul HSV)
+EFFECT_FILTERS: Dict[str, str] = {
+    "bw": "format=gray,format=yuv420p",
+    "bwcontrast": "format=gray,eq=contrast=1.35:brightness=0.0,format=yuv420p",
+    "goldenhour": "colorbalance=rs=.10:gs=.05:bs=-.05,hue=s=1.12,eq=contrast=1.06:brightness=0.03",
+    "normal": "",
+}
+
+# Encodages ffmpeg en parallèle (un process ffmpeg par job, threads côté Python)
+_PARALLEL_JOBS = max(1, (os.cpu_count() or 2) // 2)
+
+# Nb max de sorties par appel ffmpeg (chaque sortie = un encodeur et ses buffers en RAM).
+# Au-delà, la source est décodée une fois vers un cache FFV1 et les groupes repartent de ce cache.
+_MAX_OUTPUTS_PER_CMD = 4
+
+# Sessions NVENC simultanées max : plafonnées par le driver sur les GPU grand public (3, 5 ou 8)
+_NVENC_MAX_SESSIONS = int(os.environ.get("SPOOFER_NVENC_SESSIONS", "3"))
+
+# Preset x264 : "faster" par défaut, surchargeable via SPOOFER_PRESET (pas d’UI)
+_PRESET = os.environ.get("SPOOFER_PRESET", "faster")
+
 # Qualité maximale (verrouillée)
-# - H.264 lossless: -crf 0 (équiv. -qp 0). yuv420p pour compat étendue.
-# - Audio: AAC 320k @ 48 kHz
-# - faststart pour streaming web
-MAX_QUALITY_CODEC_ARGS = [
+# - NVENC si un GPU NVIDIA est dispo : h264_nvenc p5/hq, VBR à qualité constante (cq 19)
+# - Sinon H.264 CRF 18 : « visually lossless » (wiki FFmpeg H.264). yuv420p pour compat étendue.
+# - Audio: AAC 320k @ 48 kHz, ou copie directe si la source est déjà en AAC
+# - moov en tête pour streaming web : MP4 fragmenté écrit en une passe (_FRAG),
+#   ou faststart classique (réécriture complète du fichier en fin d'encodage)
+_FRAG = True
+MP4_MOVFLAGS = "+frag_keyframe+empty_moov" if _FRAG else "+faststart"
+AUDIO_CODEC_ARGS = ["-c:a", "aac", "-b:a", "320k", "-ar", "48000"]
+AUDIO_COPY_ARGS = ["-c:a", "copy"]
+
+NVENC_CODEC_ARGS = [
+    "-c:v", "h264_nvenc",
+    "-preset", "p5",
+    "-tune", "hq",
+    "-rc", "vbr",
+    "-cq", "19",
+    "-b:v", "0",
+    "-pix_fmt", "yuv420p",
+]
+X264_CODEC_ARGS = [
     "-c:v", "libx264",
     "-pix_fmt", "yuv420p",
     "-profile:v", "high",
-    "-preset", "slow",       # fixe (pas d’UI)
-    "-crf", "0",             # lossless
-    "-c:a", "aac",
-    "-b:a", "320k",
-    "-ar", "48000",
+    "-preset", _PRESET,
+    "-crf", "18",            # visually lossless
 ]
 
+NVENC_OK = FFMPEG_OK and has_nvenc()
+VIDEO_CODEC_ARGS = NVENC_CODEC_ARGS if NVENC_OK else X264_CODEC_ARGS
+if NVENC_OK:
+    # Chaque sortie d'une commande ouvre une session NVENC :
+    # jobs parallèles x sorties par commande <= _NVENC_MAX_SESSIONS
+    _MAX_OUTPUTS_PER_CMD = max(1, min(_MAX_OUTPUTS_PER_CMD, _NVENC_MAX_SESSIONS))
+    _PARALLEL_JOBS = max(1, min(_PARALLEL_JOBS, _NVENC_MAX_SESSIONS // _MAX_OUTPUTS_PER_CMD))
+
+MAX_QUALITY_CODEC_ARGS = VIDEO_CODEC_ARGS + AUDIO_CODEC_ARGS
+
+def x264_thread_args(concurrent_jobs: int, outputs_in_cmd: int) -> List[str]:
+    # Cœurs répartis entre les jobs qui tournent en même temps et les encodeurs d'une même commande :
+    # un encodage seul prend toute la machine, sans sur-souscription quand plusieurs tournent
+    if NVENC_OK:
+        return []
+    n = max(1, (os.cpu_count() or 1) // max(1, concurrent_jobs * outputs_in_cmd))
+    return ["-threads", str(n), "-x264-params", f"threads={n}:sliced-threads=0"]
+
 def ext_lower(name: str) -> str:
     return os.path.splitext(name)[1].lower()
 
-def choose_output_format(_: str) -> Tuple[str, List[str]]:
-    # Toujours MP4 ultra-compatible
+def choose_output_format(_: str, audio_codec: Optional[str] = None) -> Tuple[str, List[str]]:
+    # Toujours MP4 ultra-compatible ; l'AAC source est copié (pas de ré-encodage ni perte)
+    if audio_codec == "aac":
+        return ".mp4", VIDEO_CODEC_ARGS + AUDIO_COPY_ARGS
     return ".mp4", MAX_QUALITY_CODEC_ARGS
 
-def ffmpeg_build_filtergraph(pipeline: Iterable[str], mirror: bool, rotate_deg: int) -> str:
+def probe_audio_codec(input_path: str, input_bytes: Optional[BytesLike] = None) -> Optional[str]:
+    cmd = ["ffprobe", "-v", "error", "-select_streams", "a:0",
+           "-show_entries", "stream=codec_name", "-of", "csv=p=0", input_path]
+    try:
+        res = subprocess.run(cmd, input=input_bytes, stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=False)
+        codec = res.stdout.decode("utf-8", errors="ignore").strip()
+        return codec or None
+    except Exception:
+        return None
+
+@functools.lru_cache(maxsize=64)
+def ffmpeg_build_filtergraph(pipeline: Tuple[str, ...], mirror: bool, rotate_deg: int) -> str:
     filters = []
     rd = rotate_deg % 360
     if rd == 90:
         filters.append("transpose=1")
     elif rd == 270:
         filters.append("transpose=2")
-    elif rd == 180:
-        filters.append("rotate=PI")
 
-    if mirror:
+    # 180° = hflip+vflip (copie mémoire, sans interpolation) ; avec miroir, les deux hflip s'annulent
+    if rd == 180:
+        filters.append("vflip" if mirror else "hflip,vflip")
+    elif mirror:
         filters.append("hflip")
 
     if pipeline:
-        step = pipeline[0]
-        if step == "bw":
-            filters.append("hue=s=0")
-        elif step == "bwcontrast":
-            filters.append("hue=s=0,eq=contrast=1.35:brightness=0.0")
-        elif step == "goldenhour":
-            filters.append("colorbalance=rs=.10:gs=.05:bs=-.05,hue=s=1.12,eq=contrast=1.06:brightness=0.03")
+        effect = EFFECT_FILTERS.get(pipeline[0], "")
+        if effect:
+            filters.append(effect)
 
     return ",".join(filters) if filters else "null"
 
-def apply_variant_suffix(pipeline: Iterable[str]) -> str:
-    parts = list(pipeline)
-    return "_" + "_".join(parts) if parts else "_normal"
+def apply_variant_suffix(pipeline: Tuple[str, ...]) -> str:
+    return "_" + "_".join(pipeline) if pipeline else "_normal"
 
-def generate_variants(e_normal: bool, e_bw: bool, e_bwc: bool, e_gh: bool) -> List[List[str]]:
+def generate_variants(e_normal: bool, e_bw: bool, e_bwc: bool, e_gh: bool) -> List[Tuple[str, ...]]:
     variants = []
-    if e_normal: variants.append(["normal"])
-    if e_bw:     variants.append(["bw"])
-    if e_bwc:    variants.append(["bwcontrast"])
-    if e_gh:     variants.append(["goldenhour"])
-    if not variants: variants.append(["normal"])
+    if e_normal: variants.append(("normal",))
+    if e_bw:     variants.append(("bw",))
+    if e_bwc:    variants.append(("bwcontrast",))
+    if e_gh:     variants.append(("goldenhour",))
+    if not variants: variants.append(("normal",))
     return variants
 
-def choose_preview_pipeline(e_normal: bool, e_bw: bool, e_bwc: bool, e_gh: bool) -> List[str]:
-    if e_bwc: return ["bwcontrast"]
-    if e_bw:  return ["bw"]
-    if e_gh:  return ["goldenhour"]
-    if e_normal: return ["normal"]
-    return ["normal"]
+def choose_preview_pipeline(e_normal: bool, e_bw: bool, e_bwc: bool, e_gh: bool) -> Tuple[str, ...]:
+    if e_bwc: return ("bwcontrast",)
+    if e_bw:  return ("bw",)
+    if e_gh:  return ("goldenhour",)
+    if e_normal: return ("normal",)
+    return ("normal",)
 
 def run_ffmpeg_export(input_path: str,
-                      output_path: str,
+                      output_path: Optional[str],
                       vf_chain: str,
                       codec_args: List[str],
-                      strip_metadata: bool) -> Tuple[bool, str]:
+                      strip_metadata: bool,
+                      sink_fp: Optional[BinaryIO] = None,
+                      input_bytes: Optional[BytesLike] = None,
+                      ctl: Optional[Dict[str, Any]] = None) -> Tuple[bool, str]:
     cmd = ["ffmpeg", "-y", "-hide_banner", "-loglevel", "error", "-i", input_path, "-vf", vf_chain] + codec_args
     if strip_metadata:
         cmd += ["-map_metadata", "-1"]
-    cmd += ["-movflags", "+faststart", output_path]
+    if sink_fp is not None:
+        # Sortie non seekable : MP4 fragmenté (moov vide en tête) écrit sur stdout
+        cmd += ["-f", "mp4", "-movflags", "+frag_keyframe+empty_moov", "pipe:1"]
+    else:
+        cmd += ["-movflags", MP4_MOVFLAGS, output_path]
+    return _run_ffmpeg(cmd, sink_fp=sink_fp, input_bytes=input_bytes, ctl=ctl)
+
+def build_multi_output_cmd(input_path: str,
+                           outputs: List[Tuple[str, str]],
+                           codec_args: List[str],
+                           strip_metadata: bool) -> List[str]:
+    # Un seul décodage de la source : split=K puis une chaîne de filtres + un encodage par sortie
+    k = len(outputs)
+    graph = f"[0:v:0]split={k}" + "".join(f"[s{i}]" for i in range(k))
+    for i, (vf_chain, _) in enumerate(outputs):
+        graph += f";[s{i}]{vf_chain}[v{i}]"
+    cmd = ["ffmpeg", "-y", "-hide_banner", "-loglevel", "error", "-i", input_path, "-filter_complex", graph]
+    for i, (_, output_path) in enumerate(outputs):
+        cmd += ["-map", f"[v{i}]", "-map", "0:a:0?"] + codec_args
+        if strip_metadata:
+            cmd += ["-map_metadata", "-1"]
+        cmd += ["-movflags", MP4_MOVFLAGS, output_path]
+    return cmd
+
+def run_ffmpeg_export_multi(input_path: str,
+                            outputs: List[Tuple[str, str]],
+                            codec_args: List[str],
+                            strip_metadata: bool,
+                            input_bytes: Optional[BytesLike] = None,
+                            ctl: Optional[Dict[str, Any]] = None) -> Tuple[bool, str]:
+    return _run_ffmpeg(build_multi_output_cmd(input_path, outputs, codec_args, strip_metadata),
+                       input_bytes=input_bytes, ctl=ctl)
+
+def _run_ffmpeg(cmd: List[str],
+                sink_fp: Optional[BinaryIO] = None,
+                input_bytes: Optional[BytesLike] = None,
+                ctl: Optional[Dict[str, Any]] = None) -> Tuple[bool, str]:
+    # input_bytes : source envoyée sur stdin (la commande doit utiliser "-i pipe:0")
+    # sink_fp : stdout de ffmpeg recopié dedans (sortie "pipe:1")
+    # ctl : contrôle d'export partagé ({"cancel": Event, "procs": set}) pour tuer les ffmpeg en cours
     try:
-        res = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=False)
-        if res.returncode != 0:
-            return False, res.stderr.decode("utf-8", errors="ignore")
+        with subprocess.Popen(cmd,
+                              # DEVNULL sinon : les ffmpeg parallèles n'héritent pas du stdin/tty du serveur
+                              stdin=subprocess.PIPE if input_bytes is not None else subprocess.DEVNULL,
+                              stdout=subprocess.PIPE if sink_fp is not None else subprocess.DEVNULL,
+                              stderr=subprocess.PIPE) as proc:
+            if ctl is not None:
+                ctl["procs"].add(proc)
+                if ctl["cancel"].is_set():
+                    proc.kill()
+            # stdin/stderr gérés à part pour éviter un blocage si un pipe se remplit
+            err_lines: List[str] = []
+            fatal: List[str] = []
+            scanner = threading.Thread(target=_scan_stderr, args=(proc, err_lines, fatal), daemon=True)
+            scanner.start()
+            feeder = None
+            if input_bytes is not None:
+                feeder = threading.Thread(target=_feed_stdin, args=(proc, input_bytes), daemon=True)
+                feeder.start()
+            if sink_fp is not None:
+                shutil.copyfileobj(proc.stdout, sink_fp, length=1 << 20)
+            proc.wait()
+            scanner.join()
+            if feeder is not None:
+                feeder.join()
+            if ctl is not None:
+                ctl["procs"].discard(proc)
+        if fatal:
+            return False, fatal[0]
+        if proc.returncode != 0:
+            return False, "".join(err_lines)
         return True, ""
     except Exception as e:
         return False, str(e)
 
+def _scan_stderr(proc: subprocess.Popen, err_lines: List[str], fatal: List[str]) -> None:
+    # Source illisible : on tue ffmpeg dès l'erreur d'ouverture au lieu d'attendre la fin de l'encodage
+    for raw in proc.stderr:
+        line = raw.decode("utf-8", errors="ignore")
+        err_lines.append(line)
+        if not fatal and FFMPEG_FATAL_ERRORS.search(line):
+            fatal.append(line.strip())
+            proc.kill()
+
+def _feed_stdin(proc: subprocess.Popen, data: BytesLike) -> None:
+    try:
+        proc.stdin.write(data)
+    except (BrokenPipeError, OSError):
+        # ffmpeg s'est arrêté avant la fin : l'erreur remonte via returncode/stderr
+        pass
+    try:
+        proc.stdin.close()
+    except (BrokenPipeError, OSError):
+        pass
+
+def _make_decode_cache(input_path: str,
+                       cache_path: str,
+                       input_bytes: Optional[BytesLike] = None,
+                       ctl: Optional[Dict[str, Any]] = None) -> Tuple[bool, str]:
+    # FFV1 intra-only (-g 1) : décodage bien plus rapide que du H.264, audio copié tel quel
+    cmd = ["ffmpeg", "-y", "-hide_banner", "-loglevel", "error", "-i", input_path,
+           "-map", "0:v:0", "-map", "0:a:0?",
+           "-c:v", "ffv1", "-level", "3", "-g", "1", "-c:a", "copy", cache_path]
+    return _run_ffmpeg(cmd, input_bytes=input_bytes, ctl=ctl)
+
+def _encode_outputs(input_path: str,
+                    outputs: List[Dict[str, str]],
+                    codec_args: List[str],
+                    strip_metadata: bool,
+                    input_bytes: Optional[BytesLike] = None,
+                    ctl: Optional[Dict[str, Any]] = None) -> Tuple[bool, str]:
+    if len(outputs) == 1:
+        return run_ffmpeg_export(
+            input_path=input_path,
+            output_path=outputs[0]["out_path"],
+            vf_chain=outputs[0]["vf"],
+            codec_args=codec_args,
+            strip_metadata=strip_metadata,
+            input_bytes=input_bytes,
+            ctl=ctl,
+        )
+    return run_ffmpeg_export_multi(
+        input_path=input_path,
+        outputs=[(o["vf"], o["out_path"]) for o in outputs],
+        codec_args=codec_args,
+        strip_metadata=strip_metadata,
+        input_bytes=input_bytes,
+        ctl=ctl,
+    )
+
+def _encode_job(job: Dict[str, Any], ctl: Dict[str, Any]) -> Tuple[bool, List[Dict[str, str]], str]:
+    # Exécuté dans un worker : pas d'appel Streamlit ici
+    outputs = job["outputs"]
+    if ctl["cancel"].is_set():
+        return False, outputs, "annulé"
+    groups = [outputs[i:i + _MAX_OUTPUTS_PER_CMD] for i in range(0, len(outputs), _MAX_OUTPUTS_PER_CMD)]
+    src, src_bytes = job["in_path"], job["input_bytes"]
+    cache_path = None
+    try:
+        if len(groups) > 1:
+            cache_path = job["cache_path"]
+            ok, log = _make_decode_cache(src, cache_path, input_bytes=src_bytes, ctl=ctl)
+            if not ok:
+                return False, outputs, log
+            src, src_bytes = cache_path, None
+        for group in groups:
+            codec_args = job["codec_args"] + x264_thread_args(job["concurrent_jobs"], len(group))
+            ok, log = _encode_outputs(src, group, codec_args, job["strip_metadata"],
+                                      input_bytes=src_bytes, ctl=ctl)
+            if not ok:
+                return False, outputs, log
+        return True, outputs, ""
+    finally:
+        # Cache supprimé dès la fin de l'entrée pour borner l'espace disque
+        if cache_path and os.path.exists(cache_path):
+            os.remove(cache_path)
+
 # ------------------- Session State -------------------
 if "rotation_map" not in st.session_state:
     st.session_state.rotation_map: Dict[str, int] = {}
@@ -217,70 +461,131 @@ with col_right:
             tmp_root = None
             try:
                 progress = st.progress(0)
-                status = st.empty()
 
                 tmp_root = tempfile.mkdtemp(prefix="spoofer_video_")
-                zip_buf = io.BytesIO()
+                # ZIP en RAM jusqu'à 128 Mo, puis débordement sur disque (pas de réallocations BytesIO)
+                zip_buf = tempfile.SpooledTemporaryFile(max_size=128 * 1024 * 1024)
 
                 total_ops = len(files) * (2 if mirror_all else 1) * max(1, len(variants))
                 done = 0
 
-                with zipfile.ZipFile(zip_buf, mode="w", compression=zipfile.ZIP_STORED) as zf:
-                    for f in files:
-                        base = os.path.splitext(os.path.basename(f.name))[0]
-                        in_path = os.path.join(tmp_root, f"input__{base}{ext_lower(f.name)}")
+                # Invariants de la boucle d'export, calculés une seule fois
+                variant_suffixes = {pipeline: apply_variant_suffix(pipeline) for pipeline in variants}
+
+                jobs: List[Dict[str, Any]] = []
+                for i, f in enumerate(files):
+                    base = os.path.splitext(os.path.basename(f.name))[0]
+                    # Un dossier par job : deux uploads de même base (clip.mov / clip.mp4) encodés
+                    # en parallèle ne doivent pas partager leurs fichiers temporaires
+                    job_dir = os.path.join(tmp_root, f"job{i}")
+                    os.makedirs(job_dir)
+                    if ext_lower(f.name) in SEEKABLE_REQUIRED:
+                        in_path, input_bytes = os.path.join(job_dir, f"input__{base}{ext_lower(f.name)}"), None
                         with open(in_path, "wb") as fin:
-                            fin.write(f.getvalue())
-
-                        angle = st.session_state.rotation_map.get(f.name, 0)
-                        if angle not in ROTATIONS_ALLOWED:
-                            angle = 0
-
-                        out_ext, codec_args = choose_output_format(f.name)
-
-                        mirror_states = [False, True] if mirror_all else [st.session_state.mirror_preview]
-                        for mstate in mirror_states:
-                            for pipeline in variants:
-                                vf = ffmpeg_build_filtergraph(pipeline, mstate, angle)
-
-                                suf = ""
-                                if angle: suf += f"_rot{angle}"
-                                if mstate: suf += "_mir"
-                                suf += apply_variant_suffix(pipeline)
-
-                                out_name = f"{base}{suf}{out_ext}"
-                                out_dir = os.path.join(tmp_root, "out_flat" if flat_export else os.path.join("out", base, "Miroir" if mstate else "Normal"))
-                                os.makedirs(out_dir, exist_ok=True)
-                                out_path = os.path.join(out_dir, out_name)
-
+                            fin.write(f.getbuffer())
+                    else:
+                        # Conteneur lisible en flux : ffmpeg lit l'upload sur stdin, sans écriture disque
+                        # ni copie (vue sur le buffer de l'upload, pas de bytes dupliqués dans jobs)
+                        in_path, input_bytes = "pipe:0", f.getbuffer()
+
+                    angle = st.session_state.rotation_map.get(f.name, 0)
+                    if angle not in ROTATIONS_ALLOWED:
+                        angle = 0
+
+                    # Codec audio sondé une fois par entrée, valable pour toutes ses variantes
+                    out_ext, codec_args = choose_output_format(f.name, probe_audio_codec(in_path, input_bytes))
+
+                    if flat_export:
+                        normal_dir = mirror_dir = os.path.join(job_dir, "out_flat")
+                    else:
+                        normal_dir = os.path.join(job_dir, "out", base, "Normal")
+                        mirror_dir = os.path.join(job_dir, "out", base, "Miroir")
+
+                    outputs: List[Dict[str, str]] = []
+                    rot_suf = f"_rot{angle}" if angle else ""
+                    mirror_states = [False, True] if mirror_all else [st.session_state.mirror_preview]
+                    for mstate in mirror_states:
+                        out_dir = mirror_dir if mstate else normal_dir
+                        arc_dir = f"{base}/Miroir" if mstate else f"{base}/Normal"
+                        os.makedirs(out_dir, exist_ok=True)
+                        for pipeline in variants:
+                            out_name = f"{base}{rot_suf}{'_mir' if mstate else ''}{variant_suffixes[pipeline]}{out_ext}"
+                            outputs.append({
+                                "vf": ffmpeg_build_filtergraph(pipeline, mstate, angle),
+                                "out_path": f"{out_dir}/{out_name}",
+                                "arcname": out_name if flat_export else f"{arc_dir}/{out_name}",
+                            })
+
+                    jobs.append({
+                        "name": f.name,
+                        "in_path": in_path,
+                        "input_bytes": input_bytes,
+                        "cache_path": os.path.join(job_dir, f"cache__{base}.mkv"),
+                        "codec_args": codec_args,
+                        "strip_metadata": bool(strip_metadata),
+                        "outputs": outputs,
+                    })
+
+                # Nb de jobs réellement simultanés, pour répartir les threads x264
+                for job in jobs:
+                    job["concurrent_jobs"] = min(len(jobs), _PARALLEL_JOBS)
+
+                with st.status("Export en cours...", expanded=False) as status_box:
+                    with zipfile.ZipFile(zip_buf, mode="w", compression=zipfile.ZIP_STORED) as zf:
+                        if len(jobs) == 1 and len(jobs[0]["outputs"]) == 1:
+                            # Un seul encodage : rien à paralléliser, ffmpeg écrit directement dans le ZIP
+                            job, out = jobs[0], jobs[0]["outputs"][0]
+                            with zf.open(out["arcname"], "w", force_zip64=True) as zentry:
                                 ok, log = run_ffmpeg_export(
-                                    input_path=in_path,
-                                    output_path=out_path,
-                                    vf_chain=vf,
-                                    codec_args=codec_args,
-                                    strip_metadata=bool(strip_metadata),
+                                    input_path=job["in_path"],
+                                    output_path=None,
+                                    vf_chain=out["vf"],
+                                    codec_args=job["codec_args"] + x264_thread_args(1, 1),
+                                    strip_metadata=job["strip_metadata"],
+                                    sink_fp=zentry,
+                                    input_bytes=job["input_bytes"],
                                 )
-                                if not ok:
-                                    raise RuntimeError(f"ffmpeg a échoué pour {f.name} ({out_name}) : {log}")
-
-                                arcname = out_name if flat_export else os.path.join(base, "Miroir" if mstate else "Normal", out_name)
-                                with open(out_path, "rb") as fout:
-                                    zf.writestr(arcname, fout.read())
-
-                                done += 1
-                                progress.progress(min(1.0, done / max(1, total_ops)))
-                                status.write(f"Export: {arcname}")
-
+                            if not ok:
+                                raise RuntimeError(f"ffmpeg a échoué pour {job['name']} : {log}")
+                            done += 1
+                        else:
+                            ctl: Dict[str, Any] = {"cancel": threading.Event(), "procs": set()}
+                            with ThreadPoolExecutor(max_workers=_PARALLEL_JOBS) as ex:
+                                try:
+                                    futures = {ex.submit(_encode_job, job, ctl): job["name"] for job in jobs}
+                                    for fut in as_completed(futures):
+                                        ok, outputs, log = fut.result()
+                                        if not ok:
+                                            raise RuntimeError(f"ffmpeg a échoué pour {futures[fut]} : {log}")
+
+                                        for out in outputs:
+                                            arcname = out["arcname"]
+                                            zf.write(out["out_path"], arcname)
+
+                                            done += 1
+                                            # UI rafraîchie toutes les 4 sorties (moins de messages websocket)
+                                            if done % 4 == 0 or done == total_ops:
+                                                progress.progress(min(1.0, done / max(1, total_ops)))
+                                                status_box.update(label=f"{done}/{total_ops} : {arcname}")
+                                finally:
+                                    # Toute sortie (échec ffmpeg, disque plein, rerun/arrêt Streamlit) : jobs en
+                                    # attente annulés et ffmpeg en cours tués, sinon la sortie du with
+                                    # lancerait et attendrait tous les encodages restants
+                                    ctl["cancel"].set()
+                                    ex.shutdown(wait=False, cancel_futures=True)
+                                    for proc in list(ctl["procs"]):
+                                        proc.kill()
+                    status_box.update(label="Export terminé ! Téléchargez ci-dessous.", state="complete")
                 progress.progress(1.0)
-                status.write("Export terminé ! Téléchargez ci-dessous.")
 
                 zip_buf.seek(0)
                 st.download_button(
                     label="⬇️ Télécharger le ZIP",
-                    data=zip_buf,
+                    data=zip_buf.read(),
                     file_name="spoofer_video_export_MAX_QUALITY.zip",
                     mime="application/zip"
                 )
+                zip_buf.close()
 
             except Exception as e:
                 st.error(f"Erreur lors de l'export : {e}")
@@ -288,7 +593,14 @@ with col_right:
                 if tmp_root:
                     shutil.rmtree(tmp_root, ignore_errors=True)
 
-st.caption(
-    "Sortie: MP4 (H.264 lossless CRF=0, yuv420p) + AAC 320 kb/s, moov faststart.\n"
-    "Remarque: le mode lossless produit des fichiers volumineux et des exports plus lents."
-)
+if NVENC_OK:
+    st.caption(
+        "Sortie: MP4 fragmenté (H.264 NVENC p5/hq, VBR CQ 19, yuv420p) + AAC 320 kb/s, moov en tête.\n"
+        "Remarque: encodage matériel sur GPU NVIDIA, qualité constante proche du CRF 18 logiciel."
+    )
+else:
+    st.caption(
+        "Sortie: MP4 fragmenté (H.264 CRF=18, yuv420p) + AAC 320 kb/s, moov en tête.\n"
+        "Remarque: CRF 18 est « visually lossless » d'après le wiki FFmpeg H.264 : "
+        "aucune perte perceptible, pour des fichiers bien plus légers que le lossless CRF=0."
+    )